@@ -1,12 +1,23 @@
-from copy import deepcopy
 from heapq import heappush, heappop
 import time
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from typing import List
-from connect_four import State, Game, Player
-from copy import deepcopy
+from connect_four import State, Game, Player, PIECES
 from random import randint
 
+# Bound types of transposition table entries
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+# The best moves found for positions early in a game, keyed by the search parameters, the maximizing role and
+# the position.
+# Searches are deterministic apart from tie-breaking, so repeated games reuse them instead of searching again.
+OPENING_CACHE: dict[tuple, list[int]] = {}
+# The number of pieces in play below which positions are kept in OPENING_CACHE
+OPENING_PLIES = 6
+
 class MinimaxNode:
     """
     One node in the Minimax search tree.
@@ -38,10 +49,17 @@ class MinimaxNode:
 
 
 
-def minimax(node: MinimaxNode, depth: int, max_role: str, heuristic_fn):
+def minimax(node: MinimaxNode, depth: int, max_role: str, heuristic_fn, alpha: float = -1e10, beta: float = 1e10,
+            pv_move: int = None, tt: dict[int, tuple[int, float, int]] = None):
     """
     Performs minimax search from the given node out to a maximum depth, when heuristic evaluation is performed.
-    Generates a tree of MinimaxNodes rooted at node, with correct state, value, and successors attributes
+    Generates a tree of MinimaxNodes rooted at node, with correct value and successors attributes. The search
+    plays and undoes moves on node.state in place, which is left unchanged once the search returns.
+    Values of states already searched at least as deep are reused from the transposition table tt, in which
+    case the node's successors are not generated. The table is never consulted for the given node itself,
+    so its successors are always generated.
+    Uses alpha-beta pruning: successors that cannot affect the result are not explored, and a node whose
+    value falls strictly outside [alpha, beta] only holds a bound on its true value
 
     :param node: The node that will be the root of this search
     :type node: MinimaxNode
@@ -52,37 +70,172 @@ def minimax(node: MinimaxNode, depth: int, max_role: str, heuristic_fn):
     :param heuristic_fn: The heuristic evaluation function to be used at the max search depth
     :type heuristic_fn: Function (State str -> float), which consumes the state to be evaluated and
     :                   the maximizing player's role (either 'x' or 'o')
+    :param alpha: The value the maximizer is already guaranteed elsewhere in the tree
+    :type alpha: float
+    :param beta: The value the minimizer is already guaranteed elsewhere in the tree
+    :type beta: float
+    :param pv_move: A move to search before the others at this node, such as the best move found by a
+    :               shallower search. The other moves are searched from the center column outwards.
+    :type pv_move: int
+    :param tt: The transposition table of this search, mapping a state's Zobrist hash to the (depth, value,
+    :          bound type) of its last search. Values depend on the heuristic and the maximizing role, so a new
+    :          table is created when none is given, and shared by the recursive calls.
+    :type tt: dict[int, tuple[int, float, int]]
     :return: The evaluation of the given node
     :rtype: int
     """
     heur_value = 0
     cur_state = node.state
-    legal_moves = cur_state.get_legal_moves()
-    heur_value = heuristic_fn(cur_state, max_role)
+    entry = None
+    if tt is None:
+        tt = {}
+    else:
+        entry = tt.get(cur_state.zhash)
+    if entry is not None and entry[0] >= depth:
+        entry_value = entry[1]
+        if entry[2] == EXACT:
+            node.value = entry_value
+            return entry_value
+        elif entry[2] == LOWER:
+            alpha = max(alpha, entry_value)
+        else:
+            beta = min(beta, entry_value)
+        if alpha > beta:
+            node.value = entry_value
+            return entry_value
+    alpha_orig = alpha
+    beta_orig = beta
     if depth > 0:
-        if cur_state.turn == max_role:
+        is_max_turn = cur_state.turn == max_role
+        if is_max_turn:
             heur_value = -1e10
         else:
             heur_value = 1e10
+        # Moves near the center tend to be stronger, and expanding strong moves first lets alpha-beta prune more
+        legal_moves = cur_state.get_legal_moves()
+        legal_moves = [move for move in cur_state.center_order if move != pv_move and move in legal_moves]
+        if pv_move is not None and cur_state.move_is_legal(pv_move):
+            legal_moves.insert(0, pv_move)
         for legal_move in legal_moves:
-            scc_state = deepcopy(cur_state)
-            scc_state.advance_state(legal_move)
-            scc_node = MinimaxNode(scc_state)
+            # Successors are searched by playing the move on the shared state and undoing it afterwards,
+            # so every node in the tree refers to the same State object
+            scc_node = MinimaxNode(cur_state)
             scc_depth = depth - 1
-            node.successors.update([(legal_move, scc_node)])
-            if cur_state.turn == max_role:
-                heur_value = max(heur_value, minimax(scc_node, scc_depth, max_role, heuristic_fn))
+            node.successors[legal_move] = scc_node
+            cur_state.advance_state(legal_move)
+            scc_value = minimax(scc_node, scc_depth, max_role, heuristic_fn, alpha, beta, tt=tt)
+            cur_state.undo_move(legal_move)
+            # Cut off only on a strict inequality, so that a pruned sibling never ties with the best move
+            if is_max_turn:
+                heur_value = max(heur_value, scc_value)
+                alpha = max(alpha, heur_value)
+                if alpha > beta:
+                    break
             else:
-                heur_value = min(heur_value, minimax(scc_node, scc_depth, max_role, heuristic_fn))
+                heur_value = min(heur_value, scc_value)
+                beta = min(beta, heur_value)
+                if beta < alpha:
+                    break
     else:
         heur_value = heuristic_fn(cur_state, max_role)
         # cur_state.display()
         # print(cur_state.turn)
         # print(heur_value)
+    if heur_value < alpha_orig:
+        tt[cur_state.zhash] = (depth, heur_value, UPPER)
+    elif heur_value > beta_orig:
+        tt[cur_state.zhash] = (depth, heur_value, LOWER)
+    else:
+        tt[cur_state.zhash] = (depth, heur_value, EXACT)
     node.value = heur_value
     return heur_value
 
 
+def count_3(bits: int, line_shifts: tuple[int, int, int, int]):
+    """
+    Counts the three-in-a-rows in a bitboard, where a four-in-a-row counts as two three-in-a-rows
+
+    :param bits: The bitboard of one player's pieces
+    :type bits: int
+    :param line_shifts: The shifts that step along a column, an anti-diagonal, a row and a diagonal of the board
+    :type line_shifts: tuple[int, int, int, int]
+    :return: The number of three-in-a-rows
+    :rtype: int
+    """
+    # A bit survives the shifts and ANDs when it starts a line of three in that direction
+    col_shift, anti_diag_shift, row_shift, diag_shift = line_shifts
+    return (bits & (bits >> col_shift) & (bits >> (2 * col_shift))).bit_count() + \
+        (bits & (bits >> anti_diag_shift) & (bits >> (2 * anti_diag_shift))).bit_count() + \
+        (bits & (bits >> row_shift) & (bits >> (2 * row_shift))).bit_count() + \
+        (bits & (bits >> diag_shift) & (bits >> (2 * diag_shift))).bit_count()
+
+
+def best_successors(node: MinimaxNode):
+    """
+    Produces the moves leading to the successors of the given node with the highest value
+
+    :param node: A node whose successors have been searched
+    :type node: MinimaxNode
+    :return: The moves whose successors have the highest value
+    :rtype: List[int]
+    """
+    best_value = -1e10
+    best_moves = []
+    for move, successor in node.successors.items():
+        value = successor.value
+        if len(best_moves) == 0 or value > best_value:
+            best_value = value
+            best_moves = [move]
+        elif value == best_value:
+            best_moves.append(move)
+    return best_moves
+
+
+def choose(best_moves: List[int]):
+    """
+    Produces one of the given equally good moves at random
+
+    :param best_moves: The moves to choose from
+    :type best_moves: List[int]
+    :return: The chosen move
+    :rtype: int
+    """
+    if len(best_moves) == 1:
+        return best_moves[0]
+    return best_moves[randint(0, len(best_moves)-1)]
+
+
+def search_successor(num_cols: int, num_rows: int, turn: str, board: List[List[str]], move: int, depth: int,
+                     max_role: str, heuristic_fn):
+    """
+    Performs minimax search from the state resulting from playing the given move. Used to search the successors
+    of the root in separate processes.
+    The state is passed as its constructor arguments, which are much smaller to send to a process than a State.
+
+    :param num_cols: The number of columns (width) of the board
+    :type num_cols: int
+    :param num_rows: The number of rows (height) of the board
+    :type num_rows: int
+    :param turn: Whose turn is next, before the move is played
+    :type turn: str (one of 'x' or 'o')
+    :param board: The grid of pieces in play before the move is played
+    :type board: List[List[str]]
+    :param move: The move to play
+    :type move: int
+    :param depth: The search depth from the resulting state
+    :type depth: int
+    :param max_role: The maximizing player
+    :type max_role: str (one of 'x' or 'o')
+    :param heuristic_fn: The heuristic evaluation function to be used at the max search depth
+    :type heuristic_fn: Function (State str -> float)
+    :return: The evaluation of the resulting state
+    :rtype: float
+    """
+    state = State(num_cols, num_rows, turn, board)
+    state.advance_state(move)
+    return minimax(MinimaxNode(state), depth, max_role, heuristic_fn)
+
+
 def three_line_heur(state: State, max_role: str):
     """
     Performs a heuristic evaluation of the given state, equal to the number of three-in-a-rows for the
@@ -97,8 +250,6 @@ def three_line_heur(state: State, max_role: str):
     :return: The evaluation of the given state
     :rtype: int
     """
-    col_dirs = [1, 1, 0, -1]
-    row_dirs = [0, 1, 1, 1]
     result = 0
 
     #If the state is terminal, give the true evaluation
@@ -111,25 +262,9 @@ def three_line_heur(state: State, max_role: str):
             return -100
 
     #If the state is not terminal, give the heuristic evaluation
-    i = 0
-    while i < state.num_cols:
-        j = 0
-        while j < state.num_rows:
-            if state.board[i][j] != '.':
-                piece = state.board[i][j]
-                dir = 0
-                while dir < len(col_dirs):
-                    farthest_pnt = [i + 2 * col_dirs[dir], j + 2 * row_dirs[dir]]
-                    if state.coords_legal(farthest_pnt[0], farthest_pnt[1]):
-                        if piece == state.board[i + col_dirs[dir]][j + row_dirs[dir]] and \
-                                piece == state.board[farthest_pnt[0]][farthest_pnt[1]]:
-                            if piece == max_role:
-                                result += 1
-                            else:
-                                result -= 1
-                    dir += 1
-            j += 1
-        i += 1
+    max_bits = state.bb[PIECES.index(max_role)]
+    min_bits = state.bb[1 - PIECES.index(max_role)]
+    result = count_3(max_bits, state.line_shifts) - count_3(min_bits, state.line_shifts)
     return result
 
 
@@ -174,21 +309,8 @@ def my_heuristic(state: State, max_role: str):
     :return: The evaluation of the given state
     :rtype: int
     """
-    
-    col_dirs = [1, 1, 0, -1]
-    row_dirs = [0, 1, 1, 1]
     result = 0
 
-    def eval_four_piece(four_peice):
-        score = 0
-        distinct_items = set(four_peice)
-        distinct_items.discard('.')
-        distinct_pieces = list(distinct_items)
-            # If there's only one type of pieces in the adjacent grid points (in any direction)
-        if len(distinct_pieces) == 1:
-            score = four_peice.count(distinct_pieces[0])
-        return score
-
     #If the state is terminal, give the true evaluation
     if state.is_terminal:
         if state.winner == '':
@@ -198,28 +320,23 @@ def my_heuristic(state: State, max_role: str):
         else:
             return -100
 
-    #If the state is not terminal, give the heuristic evaluation
-    i = 0
-    while i < state.num_cols:
-        j = 0
-        while j < state.num_rows:
-            if state.board[i][j] != '.':
-                piece = state.board[i][j]
-                dir = 0
-                while dir < len(col_dirs):
-                    farthest_pnt = [i + 3 * col_dirs[dir], j + 3 * row_dirs[dir]]
-                    if state.coords_legal(farthest_pnt[0], farthest_pnt[1]):
-                        four_piece = [state.board[i + k * col_dirs[dir]][j + k * row_dirs[dir]] for k in range(4)]
-                        four_piece_score = eval_four_piece(four_piece)
-                        if piece == max_role:
-                            result += four_piece_score
-                        else:
-                            result -= four_piece_score
-                    dir += 1
-            j += 1
-        i += 1
+    #If the state is not terminal, give the heuristic evaluation: over the windows of four cells whose first
+    #cell holds a player's piece and that hold none of the other player's pieces, sum the number of that
+    #player's pieces in the window
+    max_bits = state.bb[PIECES.index(max_role)]
+    min_bits = state.bb[1 - PIECES.index(max_role)]
+    for shift, windows, first in state.four_windows:
+        shift2 = 2 * shift
+        shift3 = 3 * shift
+        max_windows = windows & ~(min_bits | (min_bits >> shift) | (min_bits >> shift2) | (min_bits >> shift3)) & \
+            (max_bits >> first)
+        min_windows = windows & ~(max_bits | (max_bits >> shift) | (max_bits >> shift2) | (max_bits >> shift3)) & \
+            (min_bits >> first)
+        result += (max_bits & max_windows).bit_count() + ((max_bits >> shift) & max_windows).bit_count() + \
+            ((max_bits >> shift2) & max_windows).bit_count() + ((max_bits >> shift3) & max_windows).bit_count()
+        result -= (min_bits & min_windows).bit_count() + ((min_bits >> shift) & min_windows).bit_count() + \
+            ((min_bits >> shift2) & min_windows).bit_count() + ((min_bits >> shift3) & min_windows).bit_count()
     return result
-    return 0
 
 
 
@@ -229,22 +346,29 @@ class MinimaxPlayer(Player):
 
     """
 
-    def __init__(self, depth: int, heur, display=True):
+    def __init__(self, depth: int, heur, display=True, workers=1):
         """
         Stores minimax parameters
 
-        :param depth: The depth at which search is terminated and a heuristic evaluation is performed
+        :param depth: The depth at which search is terminated and a heuristic evaluation is performed.
+        :             Must be at least 1, so that a move is searched.
         :type depth: int
         :param heur: The heuristic evaluation function to be used at the max search depth
         :type heur: Function (State str -> float), which consumes the state to be evaluated and
         :           the maximizing player's role (either 'x' or 'o')
         :param display: If true, print board every play
         :type display: bool
+        :param workers: If greater than 1, the number of processes the successors of the root are searched in.
+        :               Starting the processes takes time on every play, so this only pays off for deep searches.
+        :type workers: int
         """
+        if depth < 1:
+            raise ValueError("MinimaxPlayer depth must be at least 1, got {}".format(depth))
         self.role = ''
         self.depth = depth
         self.heur = heur
         self.display = display
+        self.workers = workers
 
     def initialize(self, role: str):
         """
@@ -267,15 +391,39 @@ class MinimaxPlayer(Player):
         """
         if self.display:
             state.display()
-        root = MinimaxNode(state)
-        minimax(root, self.depth, self.role, self.heur)
-        best_moves = []
-        for move in root.successors.keys():
-            if len(best_moves) == 0 or root.successors[move].value > root.successors[best_moves[0]].value:
-                best_moves = [move]
-            elif root.successors[move].value == root.successors[best_moves[0]].value:
-                best_moves.append(move)
-        return best_moves[randint(0, len(best_moves)-1)]
+        opening_key = None
+        if (state.bb[0] | state.bb[1]).bit_count() < OPENING_PLIES:
+            opening_key = (self.depth, self.heur, self.role, state.num_cols, state.num_rows, state.turn,
+                           state.bb[0], state.bb[1])
+            if opening_key in OPENING_CACHE:
+                return choose(OPENING_CACHE[opening_key])
+
+        if self.workers > 1:
+            # The successors of the root are independent, so each is searched in full in a worker process
+            root = MinimaxNode(state)
+            legal_moves = state.get_legal_moves()
+            num_moves = len(legal_moves)
+            with ProcessPoolExecutor(max_workers=min(self.workers, num_moves)) as executor:
+                values = list(executor.map(search_successor, [state.num_cols] * num_moves,
+                                           [state.num_rows] * num_moves, [state.turn] * num_moves,
+                                           [state.board] * num_moves, legal_moves, [self.depth - 1] * num_moves,
+                                           [self.role] * num_moves, [self.heur] * num_moves))
+            for move, value in zip(legal_moves, values):
+                root.successors[move] = MinimaxNode(state)
+                root.successors[move].value = value
+            best_moves = best_successors(root)
+        else:
+            # Iterative deepening: the best move of each search is tried first by the next, deeper one
+            best_move = None
+            for depth in range(1, self.depth + 1):
+                root = MinimaxNode(state)
+                minimax(root, depth, self.role, self.heur, pv_move=best_move)
+                best_moves = best_successors(root)
+                best_move = choose(best_moves)
+
+        if opening_key is not None:
+            OPENING_CACHE[opening_key] = best_moves
+        return choose(best_moves)
 
 
 
@@ -336,28 +484,29 @@ class HumanPlayer(Player):
         return col
     
 def benchmarker():
-    game1 = Game(MinimaxPlayer(3, three_line_heur), RandomPlayer())
-    game2 = Game(MinimaxPlayer(3, my_heuristic), RandomPlayer())
-    game3 = Game(MinimaxPlayer(4, three_line_heur), MinimaxPlayer(2, three_line_heur))
-    game4 = Game(MinimaxPlayer(4, my_heuristic), MinimaxPlayer(2, my_heuristic))
-    game5 = Game(MinimaxPlayer(4, my_heuristic), MinimaxPlayer(4, three_line_heur))
+    matchups = [(MinimaxPlayer(3, three_line_heur), RandomPlayer()),
+                (MinimaxPlayer(3, my_heuristic), RandomPlayer()),
+                (MinimaxPlayer(4, three_line_heur), MinimaxPlayer(2, three_line_heur)),
+                (MinimaxPlayer(4, my_heuristic), MinimaxPlayer(2, my_heuristic)),
+                (MinimaxPlayer(4, my_heuristic), MinimaxPlayer(4, three_line_heur))]
     game_results = []
-    for game in [game1, game2, game3, game4, game5]:
+    for p1, p2 in matchups:
         wins = 0
         draws = 0
         losses = 0
         for idx in range(10):
-            winner = game.play_game()
+            # A Game keeps its final state, so every game needs a new one
+            winner = Game(p1, p2).play_game()
             if winner == 'x':
                 wins += 1
             elif winner == 'o':
                 losses += 1
             else:
                 draws += 1
-        game_results.append([wins, draws, losses])
+        game_results.append((wins, draws, losses))
 
     print("Wins\t|Draws\t|Losses\t")
-    for game_result in game_results:
+    for wins, draws, losses in game_results:
         print("{}\t|{}\t|{}".format(wins, draws, losses))
 
 
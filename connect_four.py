@@ -1,13 +1,78 @@
 from typing import List
 from abc import ABC, abstractmethod
-from copy import deepcopy
 from random import randint
 
 
+# The pieces of the two players, in the order of their bitboards
+PIECES = ('x', 'o')
+
+# Random keys for Zobrist hashing, one per player and bit position. Extended as larger boards are created.
+ZOBRIST = [[], []]
+
+# The tables built by _board_tables, keyed by (num_cols, num_rows)
+_BOARD_TABLES = {}
+
+
+def _board_tables(num_cols: int, num_rows: int):
+    """
+    Produces the bit masks and orderings used by States of the given size, building them on first use.
+    Also extends ZOBRIST to cover every bit of the board.
+
+    :param num_cols: The number of columns (width) of the board
+    :type num_cols: int
+    :param num_rows: The number of rows (height) of the board
+    :type num_rows: int
+    :return: The top cell mask, the board mask, the line shifts, the four-cell windows per direction,
+    :        the four-cell windows through each bit, and the columns from the center outwards
+    :rtype: tuple
+    """
+    if (num_cols, num_rows) not in _BOARD_TABLES:
+        col_bits = num_rows + 1
+        # The top cell of every column, which is empty exactly when the column is not full
+        top_mask = 0
+        # Every cell of the board, leaving out the guard bits
+        board_mask = 0
+        for i in range(num_cols):
+            top_mask |= 1 << (i * col_bits + num_rows - 1)
+            board_mask |= ((1 << num_rows) - 1) << (i * col_bits)
+        # The shifts that step along a column, an anti-diagonal, a row and a diagonal
+        line_shifts = (1, col_bits - 1, col_bits, col_bits + 1)
+        # Per direction: its shift, the windows of four cells lying entirely on the board marked by their lowest
+        # bit, and the offset from that bit to the window's bottom cell (its highest bit along an anti-diagonal)
+        four_windows = []
+        for shift in line_shifts:
+            windows = board_mask
+            for k in range(1, 4):
+                windows &= board_mask >> (k * shift)
+            four_windows.append((shift, windows, 3 * shift if shift == col_bits - 1 else 0))
+        # For every bit, the masks of the windows of four cells on the board that contain it
+        windows_at = [[] for i in range(num_cols * col_bits)]
+        for shift, windows, first in four_windows:
+            while windows:
+                low_bit = (windows & -windows).bit_length() - 1
+                window = 0
+                for k in range(4):
+                    window |= 1 << (low_bit + k * shift)
+                for k in range(4):
+                    windows_at[low_bit + k * shift].append(window)
+                windows &= windows - 1
+        # The columns from the center outwards, ties going to the left, which is the order of decreasing strength
+        center_order = tuple(sorted(range(num_cols), key=lambda col: abs(2 * col - (num_cols - 1))))
+        while len(ZOBRIST[0]) < num_cols * col_bits:
+            for keys in ZOBRIST:
+                keys.append(randint(0, 2 ** 63 - 1))
+        _BOARD_TABLES[(num_cols, num_rows)] = (top_mask, board_mask, line_shifts, tuple(four_windows),
+                                              tuple(tuple(masks) for masks in windows_at), center_order)
+    return _BOARD_TABLES[(num_cols, num_rows)]
+
 class State:
     """
     Represents the Connect Four board.
 
+    The pieces are stored as two bitboards, one per player, where the cell (col, row) is bit
+    col * (num_rows + 1) + row. The extra bit on top of every column is always empty, which keeps
+    lines of pieces from wrapping from one column into the next when the bitboards are shifted.
+
     """
 
     def __init__(self, num_cols: int, num_rows: int, turn: str, board: list[list[str]] = None):
@@ -29,21 +94,81 @@ class State:
         self.num_rows = num_rows
         self.num_cols = num_cols
         self.turn = turn
-        self.board = board
+        # The index of the player to move in PIECES and bb, kept alongside turn for bit and hash updates
+        self.turn_idx = 0 if turn == PIECES[0] else 1
+
+        # Bits per column, including the empty guard bit on top
+        self._col_bits = num_rows + 1
+        # The bitboards of 'x' and 'o' pieces, in that order
+        self.bb = [0, 0]
+        # The first empty row of each column, kept up to date by advance_state and undo_move
+        self._heights = [0] * num_cols
+        # The Zobrist hash of the pieces in play, kept up to date by advance_state and undo_move
+        self.zhash = 0
+        # Tables that depend only on the board's size, shared by every State of that size
+        (self._top_mask, self.board_mask, self.line_shifts, self.four_windows, self._windows_at,
+         self.center_order) = _board_tables(num_cols, num_rows)
+
+        if board is not None:
+            if num_cols <= 0 or num_rows <= 0 or len(board) != num_cols or len(board[0]) != num_rows:
+                print("Warning: Board was initialized with incorrect size.")
+            for i in range(min(len(board), num_cols)):
+                for j in range(min(len(board[i]), num_rows)):
+                    if board[i][j] != '.':
+                        self.bb[PIECES.index(board[i][j])] |= 1 << (i * self._col_bits + j)
+                        self.zhash ^= ZOBRIST[PIECES.index(board[i][j])][i * self._col_bits + j]
+                height = 0
+                while height < min(len(board[i]), num_rows) and board[i][height] != '.':
+                    height += 1
+                self._heights[i] = height
+
+        # The legal moves of the current board, computed on demand and cleared whenever the board changes
+        self._legal_moves = None
+        self.winner = self.four_in_a_row()
+        self.is_terminal = self.winner != '' or self.is_full()
+
 
-        if self.board is None:
-            self.board = []
-            for i in range(num_cols):
-                new_row = []
-                for j in range(num_rows):
+    @property
+    def board(self):
+        """
+        The grid of pieces in play, decoded from the bitboards. Note: coordinates are grid[column][row]
+        where grid[0][0] is the bottom left corner. A new grid is produced on every access, so changing
+        it does not alter the state.
+
+        :rtype: List[List[str]], where strings are one of '.' (empty position), 'x', or 'o'
+        """
+        result = []
+        for i in range(self.num_cols):
+            new_row = []
+            for j in range(self.num_rows):
+                bit = 1 << (i * self._col_bits + j)
+                if self.bb[0] & bit:
+                    new_row.append(PIECES[0])
+                elif self.bb[1] & bit:
+                    new_row.append(PIECES[1])
+                else:
                     new_row.append('.')
-                self.board.append(new_row)
-        elif num_cols <= 0 or num_rows <= 0 or len(self.board) != num_cols or len(self.board[0]) != num_rows:
-            print("Warning: Board was initialized with incorrect size.")
+            result.append(new_row)
+        return result
 
-        self.is_terminal = False
-        self.winner = self.four_in_a_row()
-        self.is_terminal = self.winner != '' or len(self.get_legal_moves()) == 0
+
+    def __deepcopy__(self, memo):
+        """
+        Produces an independent copy of this State. Used by copy.deepcopy. Only the mutable lists are copied;
+        the bitboards, masks and other attributes are immutable and are shared with the copy.
+
+        :param memo: The deepcopy memo dictionary
+        :type memo: dict
+        :return: The copy
+        :rtype: State
+        """
+        result = type(self).__new__(type(self))
+        result.__dict__.update(self.__dict__)
+        result.bb = self.bb[:]
+        result._heights = self._heights[:]
+        result._legal_moves = None
+        memo[id(self)] = result
+        return result
 
 
     def __eq__(self, other):
@@ -55,7 +180,7 @@ class State:
         :return: True if equal, False otherwise
         :rtype: bool
         """
-        return self.board == other.board
+        return self.num_cols == other.num_cols and self.num_rows == other.num_rows and self.bb == other.bb
 
 
     def coords_legal(self, col: int, row: int):
@@ -69,7 +194,23 @@ class State:
         :return: True if in-bounds, false otherwise
         :rtype: bool
         """
-        return col >= 0 and col < self.num_cols and row >= 0 and row < self.num_rows
+        return 0 <= col < self.num_cols and 0 <= row < self.num_rows
+
+
+    def has_four(self, bits: int):
+        """
+        Produces True if the given bitboard contains a vertical, horizontal, or diagonal four-in-a-row
+
+        :param bits: A bitboard laid out like the ones of this state
+        :type bits: int
+        :return: True if there is a four-in-a-row, False otherwise
+        :rtype: bool
+        """
+        for shift in self.line_shifts:
+            pairs = bits & (bits >> shift)
+            if pairs & (pairs >> (2 * shift)):
+                return True
+        return False
 
 
     def four_in_a_row(self):
@@ -81,33 +222,24 @@ class State:
         :        are four 'o's in a row
         :rtype: str
         """
-
         result = ''
-        found = False
-        col_dirs = [1, 1, 0, -1]
-        row_dirs = [0, 1, 1, 1]
-
-        i = 0
-        while i < self.num_cols and not found:
-            j = 0
-            while j < self.num_rows and not found:
-                if self.board[i][j] != '.':
-                    piece = self.board[i][j]
-                    dir = 0
-                    while dir < len(col_dirs) and not found:
-                        farthest_pnt = [i + 3 * col_dirs[dir], j + 3 * row_dirs[dir]]
-                        if self.coords_legal(farthest_pnt[0], farthest_pnt[1]):
-                            if piece == self.board[i + col_dirs[dir]][j + row_dirs[dir]] and \
-                                    piece == self.board[i + 2 * col_dirs[dir]][j + 2 * row_dirs[dir]] and \
-                                    piece == self.board[farthest_pnt[0]][farthest_pnt[1]]:
-                                result = piece
-                                found = True
-                        dir += 1
-                j += 1
-            i += 1
+        if self.has_four(self.bb[0]):
+            result = PIECES[0]
+        elif self.has_four(self.bb[1]):
+            result = PIECES[1]
         return result
 
 
+    def is_full(self):
+        """
+        Produces True if every column of the board is full, and False otherwise
+
+        :return: True if full, False otherwise
+        :rtype: bool
+        """
+        return self._top_mask & ~(self.bb[0] | self.bb[1]) == 0
+
+
     def move_is_legal(self, col: int):
         """
         Produces True if it is legal to drop a piece into the given column, and False otherwise
@@ -117,23 +249,27 @@ class State:
         :return: True if legal, False otherwise
         :rtype: bool
         """
-        return col >= 0 and col < self.num_cols and self.board[col][self.num_rows-1] == '.' and not self.is_terminal
+        return 0 <= col < self.num_cols and self._heights[col] < self.num_rows and not self.is_terminal
 
 
     def get_legal_moves(self):
         """
         Produces a list of legal moves (i.e. columns indices that a piece may be dropped into),
-        given the current state
+        given the current state. Note: the list is kept by the state until its board changes, so it must
+        not be modified.
 
         :return: A list of legal moves
         :rtype: List[int]
         """
-        result = []
-        if not self.is_terminal:
-            for i in range(self.num_cols):
-                if self.move_is_legal(i):
-                    result.append(i)
-        return result
+        if self._legal_moves is None:
+            self._legal_moves = []
+            if not self.is_terminal:
+                # Walk the empty top cells from the lowest bit up, which lists the columns in increasing order
+                free = self._top_mask & ~(self.bb[0] | self.bb[1])
+                while free:
+                    self._legal_moves.append(((free & -free).bit_length() - 1) // self._col_bits)
+                    free &= free - 1
+        return self._legal_moves
 
 
     def get_first_empty_row(self, col: int):
@@ -146,11 +282,8 @@ class State:
         :rtype: int
         """
         result = -1
-        if col >= 0 and col < self.num_cols:
-            for i in range(self.num_rows):
-                if self.board[col][i] == '.':
-                    result = i
-                    break
+        if col >= 0 and col < self.num_cols and self._heights[col] < self.num_rows:
+            result = self._heights[col]
         return result
 
 
@@ -166,7 +299,7 @@ class State:
         """
         result = None
         if self.move_is_legal(move):
-            result = deepcopy(self.board)
+            result = self.board
             place_row = self.get_first_empty_row(move)
             result[move][place_row] = self.turn
         return result
@@ -183,15 +316,50 @@ class State:
         :rtype: bool
         """
         result = False
-        if not self.is_terminal and self.move_is_legal(move):
-            place_row = self.get_first_empty_row(move)
-            self.board[move][place_row] = self.turn
-            if self.turn == 'x':
-                self.turn = 'o'
-            else:
-                self.turn = 'x'
-            self.winner = self.four_in_a_row()
-            self.is_terminal = self.winner != '' or len(self.get_legal_moves()) == 0
+        # The check of move_is_legal, written out since this runs for every node of a search
+        if not self.is_terminal and 0 <= move < self.num_cols and self._heights[move] < self.num_rows:
+            turn_idx = self.turn_idx
+            place_bit = move * self._col_bits + self._heights[move]
+            self.bb[turn_idx] |= 1 << place_bit
+            self.zhash ^= ZOBRIST[turn_idx][place_bit]
+            self._heights[move] += 1
+            self.turn_idx = 1 - turn_idx
+            self.turn = PIECES[self.turn_idx]
+            # Only a window of four containing the new piece can have been completed
+            bits = self.bb[turn_idx]
+            for window in self._windows_at[place_bit]:
+                if bits & window == window:
+                    self.winner = PIECES[turn_idx]
+                    break
+            self.is_terminal = self.winner != '' or self.is_full()
+            self._legal_moves = None
+            result = True
+        return result
+
+
+    def undo_move(self, move: int):
+        """
+        Reverts the state to before the given move was played. The top piece of the column is removed, and the
+        turn passes back to the player who made the move. Note: the move must be the last one played,
+        since the state before it is assumed to be non-terminal.
+
+        :param move: The column index that the last piece was dropped into
+        :type move: int
+        :return: True if successful, False if the given column is empty
+        :rtype: bool
+        """
+        result = False
+        if move >= 0 and move < self.num_cols and self._heights[move] > 0:
+            self._heights[move] -= 1
+            turn_idx = 1 - self.turn_idx
+            self.turn_idx = turn_idx
+            self.turn = PIECES[turn_idx]
+            place_bit = move * self._col_bits + self._heights[move]
+            self.bb[turn_idx] &= ~(1 << place_bit)
+            self.zhash ^= ZOBRIST[turn_idx][place_bit]
+            self.winner = ''
+            self.is_terminal = False
+            self._legal_moves = None
             result = True
         return result
 
@@ -210,6 +378,7 @@ class State:
         | . x x o . . o |
         +---------------+
         """
+        board = self.board
 
         def print_cap():
             print('+', end='')
@@ -220,7 +389,7 @@ class State:
         def print_grid_line(row_index):
             print_str = '| '
             for i in range(self.num_cols):
-                print_str += self.board[i][row_index] + ' '
+                print_str += board[i][row_index] + ' '
             print_str += '|'
             print(print_str)
 
@@ -252,7 +421,8 @@ class Player(ABC):
     def play(self, state: State):
         """
         This function is called every time it is the player's turn. It produces the column number that a
-        piece should be dropped into
+        piece should be dropped into. Note: the state is the game's own State rather than a copy, so the
+        player must leave it as it was given. Moves played on it while searching must be undone before returning.
 
         :param state: the game's current State
         :type state: State
@@ -299,9 +469,9 @@ class Game:
 
         while(not self.__game_state.is_terminal):
             if(self.__game_state.turn == 'x'):
-                move = self.__p1.play(deepcopy(self.__game_state))
+                move = self.__p1.play(self.__game_state)
             else:
-                move = self.__p2.play(deepcopy(self.__game_state))
+                move = self.__p2.play(self.__game_state)
             self.__game_state.advance_state(move)
         return self.__game_state.winner
 